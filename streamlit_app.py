@@ -1,20 +1,75 @@
 import streamlit as st
-import google.generativeai as genai
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 import json
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import re
 
-# Configure the page
-st.set_page_config(
-    page_title="Auxílio de Diagnóstico (ALPHA)",
-    page_icon="🏥",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+MODEL_NAME = 'gemini-2.5-flash'
+GEMINI_TIMEOUT_SECONDS = 30
+BATCH_WINDOW_SECONDS = 2
 
-# Custom CSS for better styling
-st.markdown("""
+# Structured-output schema Gemini is constrained to, mirroring JSON_SCHEMA_SUFFIX.
+# Every key is listed as required; a TypedDict schema is sent without any
+DIAGNOSIS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "condition": {"type": "string"},
+                    "probability": {"type": "integer"}
+                },
+                "required": ["condition", "probability"]
+            }
+        },
+        "follow_up_questions": {"type": "array", "items": {"type": "string"}},
+        "suggested_conduct": {"type": "string"},
+        "suggested_followup": {"type": "string"}
+    },
+    "required": ["diagnoses", "follow_up_questions", "suggested_conduct", "suggested_followup"]
+}
+
+# Static prompt parts around the append-only consultation history
+SYSTEM_PREFIX = """
+As a medical AI assistant, analyze the following consultation data and provide:
+
+Consultation Data:
+"""
+
+JSON_SCHEMA_SUFFIX = """
+Please provide your response in the following JSON format:
+{
+    "diagnoses": [
+        {"condition": "Diagnosis 1", "probability": 85},
+        {"condition": "Diagnosis 2", "probability": 70},
+        {"condition": "Diagnosis 3", "probability": 45},
+        {"condition": "Diagnosis 4", "probability": 30}
+    ],
+    "follow_up_questions": [
+        "Question 1 to gather more information",
+        "Question 2 to clarify symptoms",
+        "Question 3 to understand duration"
+    ],
+    "suggested_conduct": "Immediate actions and treatment recommendations, in Brazilian Portuguese",
+    "suggested_followup": "Recommended examinations, tests, and follow-up appointments, in Brazilian Portuguese"
+}
+
+Important:
+- Diagnoses should be ranked by probability (highest first) and must be in Brazilian Portuguese
+- Probabilities should be realistic and sum to reasonable medical uncertainty
+- Follow-up questions should be specific and relevant to the current information
+- Conduct suggestions should be immediate, actionable medical advice
+- Follow-up should include specific tests, examinations, or specialist referrals
+- Keep medical advice general and emphasize the need for proper medical evaluation
+"""
+
+# Static HTML, emitted on every rerun: Streamlit drops any element a run does not re-send
+CUSTOM_CSS = """
 <style>
     .main-header {
         font-size: 2.5rem;
@@ -30,13 +85,6 @@ st.markdown("""
         margin-top: 1rem;
         margin-bottom: 0.5rem;
     }
-    .diagnosis-item {
-        background-color: #f8f9fa;
-        padding: 10px;
-        border-radius: 5px;
-        margin-bottom: 5px;
-        border-left: 4px solid #1f77b4;
-    }
     .follow-up-question {
         background-color: #e8f4fd;
         padding: 8px;
@@ -50,11 +98,27 @@ st.markdown("""
         border-radius: 5px;
         border-left: 4px solid #28a745;
     }
-    .stProgress > div > div > div > div {
-        background-color: #1f77b4;
-    }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+DISCLAIMER_HTML = """
+    <div style='text-align: center; color: #666; font-size: 0.9rem; margin-top: 2rem;'>
+        ⚠️ <strong>Informação Legal:</strong> Essa ferramenta, no estado atual, está em desenvolvimento. 
+        Ela não deve nem pode substituir uma consulta médica completa, nem o discernimento do profissional médico. 
+        Sempre verifique as informações e as valide com as guidelines mais atualizadas.
+    </div>
+    """
+
+# Configure the page
+st.set_page_config(
+    page_title="Auxílio de Diagnóstico (ALPHA)",
+    page_icon="🏥",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+# Custom CSS for better styling
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # Initialize session state
 if 'consultation_data' not in st.session_state:
@@ -69,102 +133,198 @@ if 'suggested_conduct' not in st.session_state:
     st.session_state.suggested_conduct = ""
 if 'suggested_followup' not in st.session_state:
     st.session_state.suggested_followup = ""
-if 'input_key' not in st.session_state:
-    st.session_state.input_key = 0
+if 'pending_inputs' not in st.session_state:
+    st.session_state.pending_inputs = []
+if 'pending_deadline' not in st.session_state:
+    st.session_state.pending_deadline = 0.0
+if 'flush_pending' not in st.session_state:
+    st.session_state.flush_pending = False
+if 'form_key' not in st.session_state:
+    st.session_state.form_key = 0
 
+@st.cache_resource(show_spinner=False)
 def configure_gemini(api_key):
-    """Configure Gemini AI with the provided API key"""
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        return model
-    except Exception as e:
-        st.error(f"Error configuring Gemini AI: {str(e)}")
-        return None
-
-def get_ai_analysis(consultation_data, model):
-    """Get AI analysis for diagnoses, follow-up questions, and conduct suggestions"""
+    """Configure Gemini AI with the provided API key, reusing the model across reruns.
     
-    # Prepare the consultation history
-    consultation_text = "\n".join([f"Input {i+1}: {data}" for i, data in enumerate(consultation_data)])
+    Failures raise instead of returning None so they are never cached.
+    """
+    # Imported here so the API key prompt renders without loading the SDK (grpc, protobuf)
+    import google.generativeai as genai
+    from google.ai import generativelanguage as glm
     
-    prompt = f"""
-As a medical AI assistant, analyze the following consultation data and provide:
+    model = genai.GenerativeModel(
+        MODEL_NAME,
+        generation_config=genai.GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=DIAGNOSIS_RESPONSE_SCHEMA
+        )
+    )
+    # The cached model owns a client bound to this key instead of relying on the
+    # process-wide genai.configure, which other sessions' keys would overwrite.
+    # GenerativeModel has no public way to pass a client, so this sets the private
+    # _client attribute as of google-generativeai 0.8.x (pinned in requirements.txt)
+    model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    return model
 
-Consultation Data:
-{consultation_text}
+def extract_streamed_diagnoses(response_text):
+    """Return the diagnosis objects already closed in a partially streamed response"""
+    key_index = response_text.find('"diagnoses"')
+    if key_index == -1:
+        return []
+    array_start = response_text.find('[', key_index)
+    if array_start == -1:
+        return []
+    
+    diagnoses = []
+    depth = 0
+    object_start = -1
+    in_string = False
+    escaped = False
+    for i in range(array_start + 1, len(response_text)):
+        char = response_text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            if depth == 0:
+                object_start = i
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                try:
+                    diagnoses.append(json.loads(response_text[object_start:i + 1]))
+                except json.JSONDecodeError:
+                    pass
+        elif char == ']' and depth == 0:
+            break
+    return diagnoses
 
-Please provide your response in the following JSON format:
-{{
-    "diagnoses": [
-        {{"condition": "Diagnosis 1", "probability": 85}},
-        {{"condition": "Diagnosis 2", "probability": 70}},
-        {{"condition": "Diagnosis 3", "probability": 45}},
-        {{"condition": "Diagnosis 4", "probability": 30}}
-    ],
-    "follow_up_questions": [
-        "Question 1 to gather more information",
-        "Question 2 to clarify symptoms",
-        "Question 3 to understand duration"
-    ],
-    "suggested_conduct": "Immediate actions and treatment recommendations, in Brazilian Portuguese",
-    "suggested_followup": "Recommended examinations, tests, and follow-up appointments, in Brazilian Portuguese"
-}}
+def is_retryable_error(error):
+    """Whether a Gemini failure is transient and worth retrying with backoff"""
+    from google.api_core import exceptions as google_exceptions
+    
+    return isinstance(error, (
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.ResourceExhausted,
+    ))
 
-Important:
-- Diagnoses should be ranked by probability (highest first) and must be in Brazilian Portuguese
-- Probabilities should be realistic and sum to reasonable medical uncertainty
-- Follow-up questions should be specific and relevant to the current information
-- Conduct suggestions should be immediate, actionable medical advice
-- Follow-up should include specific tests, examinations, or specialist referrals
-- Keep medical advice general and emphasize the need for proper medical evaluation
-"""
+@retry(
+    retry=retry_if_exception(is_retryable_error),
+    wait=wait_exponential(min=1, max=8),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+def stream_response(prompt, model, on_text):
+    """Stream a Gemini response, calling on_text with the accumulated text after each chunk"""
+    response = model.generate_content(
+        prompt,
+        stream=True,
+        request_options={"timeout": GEMINI_TIMEOUT_SECONDS}
+    )
+    
+    response_text = ""
+    for chunk in response:
+        if not chunk.parts:
+            continue
+        response_text += chunk.text
+        on_text(response_text)
+    return response_text
+
+@st.cache_data(show_spinner=False, ttl=1800, max_entries=128)
+def get_ai_analysis(history: tuple[str, ...], api_key: str, _on_text):
+    """Get AI analysis for diagnoses, follow-up questions, and conduct suggestions.
+    
+    Identical histories are answered from the cache instead of Gemini. The function
+    makes no Streamlit calls, so a cache hit has nothing to replay; _on_text only
+    receives the accumulated text on a miss. Failures raise instead of returning
+    None so they are never cached.
+    """
+    model = configure_gemini(api_key)
+    
+    # Inputs are only ever appended, so everything before the newest one stays
+    # byte-identical between turns and Gemini's implicit prefix cache can reuse it
+    consultation_text = "".join(f"Input {i+1}: {data}\n" for i, data in enumerate(history))
+    prompt = SYSTEM_PREFIX + consultation_text + JSON_SCHEMA_SUFFIX
+    
+    response_text = stream_response(prompt, model, _on_text)
+    
+    # The response schema makes the whole text the JSON object, but it can still be
+    # missing keys; raising keeps a malformed analysis out of the cache
+    analysis = json.loads(response_text)
+    if not isinstance(analysis, dict) or not isinstance(analysis.get("diagnoses"), list):
+        raise ValueError("Could not parse AI response. Please try again.")
+    return analysis
 
+def stream_ai_analysis(history, api_key):
+    """Run get_ai_analysis on a worker thread, drawing each diagnosis as it streams in.
+    
+    Streamed text comes back through a queue and is rendered here on the script
+    thread, keeping every Streamlit call outside the cached function.
+    """
+    live_diagnoses = st.empty()
+    shown_diagnoses = 0
+    response_text = ""
+    
+    partial_text = queue.Queue()
+    ctx = get_script_run_ctx()
+    executor = ThreadPoolExecutor(max_workers=1, initializer=add_script_run_ctx, initargs=(None, ctx))
     try:
-        st.write("🔍 Debug: Mandando request...")
-        response = model.generate_content(prompt)
-        
-        # Extract JSON from response
-        response_text = response.text
-        st.write("🔍 Debug: Resposta recebida")
-        st.write("🔍 Debug: Preview da resposta:", response_text[:200] + "..." if len(response_text) > 200 else response_text)
-        
-        # Find JSON in the response
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group()
-            st.write("🔍 Debug: Found JSON in response")
-            analysis = json.loads(json_str)
-            st.write("🔍 Debug: Successfully parsed JSON")
-            return analysis
-        else:
-            st.error("Could not parse AI response. Please try again.")
-            st.write("🔍 Debug: No JSON found in response")
-            return None
+        future = executor.submit(get_ai_analysis, history, api_key, partial_text.put)
+        while not (future.done() and partial_text.empty()):
+            try:
+                latest_text = partial_text.get(timeout=0.1)
+            except queue.Empty:
+                continue
             
-    except json.JSONDecodeError as e:
-        st.error(f"Error parsing AI response: {str(e)}")
-        st.write("🔍 Debug: JSON decode error")
-        return None
-    except Exception as e:
-        st.error(f"Error getting AI analysis: {str(e)}")
-        st.write(f"🔍 Debug: General error: {str(e)}")
-        return None
+            # Shorter text means a retry restarted the stream, so drop the old bars
+            if len(latest_text) < len(response_text):
+                live_diagnoses.empty()
+                shown_diagnoses = 0
+            response_text = latest_text
+            
+            diagnoses = extract_streamed_diagnoses(response_text)
+            if diagnoses and len(diagnoses) != shown_diagnoses:
+                shown_diagnoses = len(diagnoses)
+                with live_diagnoses.container():
+                    display_probability_bars(diagnoses)
+    finally:
+        # Don't block a stopped script run on an unfinished request
+        executor.shutdown(wait=False)
+    
+    try:
+        analysis = future.result()
+    except Exception:
+        # Don't leave bars from the failed response next to the previous results
+        live_diagnoses.empty()
+        raise
+    return analysis
 
 def display_probability_bars(diagnoses):
-    """Display diagnosis probabilities as progress bars"""
+    """Display diagnosis probabilities as a single horizontal bar chart"""
+    import altair as alt
+    import pandas as pd
+    
     st.markdown('<div class="section-header">🎯 Possíveis Diagnósticos</div>', unsafe_allow_html=True)
     
-    for i, diagnosis in enumerate(diagnoses):
-        col1, col2 = st.columns([3, 1])
-        
-        with col1:
-            st.markdown(f'<div class="diagnosis-item"><strong>{diagnosis["condition"]}</strong></div>', 
-                       unsafe_allow_html=True)
-            st.progress(diagnosis["probability"] / 100)
-        
-        with col2:
-            st.metric("Probability", f"{diagnosis['probability']}%")
+    chart_data = pd.DataFrame(diagnoses, columns=["condition", "probability"])
+    bars = alt.Chart(chart_data).mark_bar(color="#1f77b4").encode(
+        x=alt.X("probability:Q", title="Probabilidade (%)", scale=alt.Scale(domain=[0, 100])),
+        y=alt.Y("condition:N", title=None, sort=None, axis=alt.Axis(labelLimit=300)),
+        tooltip=[alt.Tooltip("condition:N", title="Diagnóstico"), alt.Tooltip("probability:Q", title="%")]
+    )
+    labels = bars.mark_text(align="left", dx=4).encode(
+        text=alt.Text("label:N")
+    ).transform_calculate(label="datum.probability + '%'")
+    st.altair_chart((bars + labels).properties(width="container"))
 
 def display_follow_up_questions(questions):
     """Display suggested follow-up questions"""
@@ -174,6 +334,15 @@ def display_follow_up_questions(questions):
         st.markdown(f'<div class="follow-up-question"><strong>Q{i+1}:</strong> {question}</div>', 
                    unsafe_allow_html=True)
 
+@st.fragment(run_every=BATCH_WINDOW_SECONDS)
+def watch_pending_inputs():
+    """Show the queued inputs and trigger their analysis once the batch window elapses"""
+    st.caption(f"⏳ {len(st.session_state.pending_inputs)} entrada(s) aguardando análise")
+    
+    if time.monotonic() >= st.session_state.pending_deadline:
+        st.session_state.flush_pending = True
+        st.rerun()
+
 def main():
     # Header
     st.markdown('<div class="main-header">🏥 Auxílio de Diagnóstico (ALPHA)</div>', unsafe_allow_html=True)
@@ -202,11 +371,14 @@ def main():
         
         if st.button("🗑️ Limpar Histórico", type="secondary"):
             st.session_state.consultation_data = []
+            st.session_state.pending_inputs = []
+            st.session_state.flush_pending = False
             st.session_state.current_diagnoses = []
             st.session_state.follow_up_questions = []
             st.session_state.suggested_conduct = ""
             st.session_state.suggested_followup = ""
-            st.session_state.input_key += 1
+            # A new form key also discards any unsubmitted draft in the text area
+            st.session_state.form_key += 1
             st.rerun()
 
     # Main content area
@@ -216,42 +388,76 @@ def main():
         return
 
     # Configure Gemini
-    model = configure_gemini(st.session_state.api_key)
-    if not model:
+    try:
+        configure_gemini(st.session_state.api_key)
+    except Exception as e:
+        st.error(f"Error configuring Gemini AI: {str(e)}")
         return
 
     # Input section
     st.markdown('<div class="section-header">📝 Informações do Caso Clínico</div>', unsafe_allow_html=True)
     
-    # Text input for medical data
-    medical_input = st.text_area(
-        "Insira dados acerca do caso clínico:",
-        placeholder="Sintomas, sinais vitais, exame físico, histórico médico, etc.",
-        height=150,
-        key=f"medical_input_{st.session_state.input_key}"
-    )
+    # The form clears the text area itself on submit, so no extra rerun is needed
+    with st.form(f"case_form_{st.session_state.form_key}", clear_on_submit=True, border=False):
+        # Text input for medical data
+        medical_input = st.text_area(
+            "Insira dados acerca do caso clínico:",
+            placeholder="Sintomas, sinais vitais, exame físico, histórico médico, etc.",
+            height=150,
+            key=f"medical_input_{st.session_state.form_key}"
+        )
+        process_clicked = st.form_submit_button("➕ Processar", type="primary")
     
-    col1, col2 = st.columns([1, 4])
-    with col1:
-        if st.button("➕ Processar", type="primary"):
-            if medical_input.strip():
-                st.session_state.consultation_data.append(medical_input.strip())
-                
-                # Get AI analysis
-                with st.spinner("🤖 Analizando informações com a IA..."):
-                    analysis = get_ai_analysis(st.session_state.consultation_data, model)
-                    
-                    if analysis:
-                        st.session_state.current_diagnoses = analysis.get("diagnoses", [])
-                        st.session_state.follow_up_questions = analysis.get("follow_up_questions", [])
-                        st.session_state.suggested_conduct = analysis.get("suggested_conduct", "")
-                        st.session_state.suggested_followup = analysis.get("suggested_followup", "")
-                
-                # Clear input by incrementing key and rerun
-                st.session_state.input_key += 1
-                st.rerun()
-            else:
-                st.error("Please enter some medical data before adding.")
+    # Submissions are queued and analysed together in a single Gemini call, either
+    # on demand or once the batch window passes without a new submission
+    if process_clicked:
+        if medical_input.strip():
+            st.session_state.pending_inputs.append(medical_input.strip())
+            st.session_state.pending_deadline = time.monotonic() + BATCH_WINDOW_SECONDS
+        else:
+            st.error("Please enter some medical data before adding.")
+    
+    analyze_clicked = st.button("🤖 Analisar", disabled=not st.session_state.pending_inputs)
+    
+    # Handled outside the form so streamed diagnoses render at full width
+    if st.session_state.pending_inputs and (analyze_clicked or st.session_state.flush_pending):
+        st.session_state.flush_pending = False
+        history = tuple(st.session_state.consultation_data + st.session_state.pending_inputs)
+        
+        # Get AI analysis
+        with st.spinner("🤖 Analizando informações com a IA..."):
+            try:
+                analysis = stream_ai_analysis(history, st.session_state.api_key)
+            except json.JSONDecodeError as e:
+                st.error(f"Error parsing AI response: {str(e)}")
+                analysis = None
+            except Exception as e:
+                st.error(f"Error getting AI analysis: {str(e)}")
+                analysis = None
+            
+            if analysis is not None:
+                # Queued inputs join the history only once they have been analysed
+                st.session_state.consultation_data = list(history)
+                st.session_state.pending_inputs = []
+                st.session_state.current_diagnoses = analysis.get("diagnoses", [])
+                st.session_state.follow_up_questions = analysis.get("follow_up_questions", [])
+                st.session_state.suggested_conduct = analysis.get("suggested_conduct", "")
+                st.session_state.suggested_followup = analysis.get("suggested_followup", "")
+        
+        # Only rerun on success so a failure's error message stays on screen
+        if analysis is not None:
+            st.rerun()
+        
+        # Keep the failed batch queued for a manual retry with Analisar rather
+        # than re-sending it every batch window
+        st.session_state.pending_deadline = float("inf")
+    
+    if st.session_state.pending_inputs:
+        if st.session_state.pending_deadline == float("inf"):
+            # Nothing will flush a failed batch on its own, so don't keep polling
+            st.caption(f"⏳ {len(st.session_state.pending_inputs)} entrada(s) aguardando análise")
+        else:
+            watch_pending_inputs()
 
     # Display results if we have consultation data
     if st.session_state.consultation_data:
@@ -288,13 +494,7 @@ def main():
     
     # Footer disclaimer
     st.markdown("---")
-    st.markdown("""
-    <div style='text-align: center; color: #666; font-size: 0.9rem; margin-top: 2rem;'>
-        ⚠️ <strong>Informação Legal:</strong> Essa ferramenta, no estado atual, está em desenvolvimento. 
-        Ela não deve nem pode substituir uma consulta médica completa, nem o discernimento do profissional médico. 
-        Sempre verifique as informações e as valide com as guidelines mais atualizadas.
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(DISCLAIMER_HTML, unsafe_allow_html=True)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file